@@ -1,19 +1,31 @@
 """List available cameras using different methods."""
+import argparse
 import cv2
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument(
+    "--msmf",
+    action="store_true",
+    help="also probe Media Foundation (opens can take minutes on some USB cameras)"
+)
+args = parser.parse_args()
+
 print("Testing camera indices with different backends...\n")
 
 backends = [
     ("CAP_DSHOW (DirectShow)", cv2.CAP_DSHOW),
-    ("CAP_MSMF (Media Foundation)", cv2.CAP_MSMF),
     ("CAP_ANY (Auto)", cv2.CAP_ANY),
 ]
+if args.msmf:
+    backends.insert(1, ("CAP_MSMF (Media Foundation)", cv2.CAP_MSMF))
 
 for backend_name, backend in backends:
     print(f"=== {backend_name} ===")
     for i in range(3):
         cap = cv2.VideoCapture(i, backend)
         if cap.isOpened():
+            # Request MJPG so full resolution fits in USB bandwidth
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             ret, frame = cap.read()
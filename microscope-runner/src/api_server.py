@@ -1,10 +1,14 @@
 """FastAPI server for microscope capture service."""
 
+import asyncio
 import logging
 from datetime import datetime
 from contextlib import asynccontextmanager
+from functools import partial
+from pathlib import Path
+from typing import Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .config import settings
@@ -14,7 +18,7 @@ from .models import (
     HealthResponse,
     CameraTestResponse,
 )
-from .microscope_controller import microscope
+from .microscope_controller import fit_long_edge, microscope
 
 # Configure logging
 logging.basicConfig(
@@ -23,8 +27,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Track busy state
-_is_busy = False
+# Serializes camera use across capture requests
+_capture_lock = asyncio.Lock()
+
+# Last camera probe result: (available, error)
+_last_probe: Tuple[bool, Optional[str]] = (False, None)
 
 # Lazy load Drive and Sheets integrations
 _drive_uploader = None
@@ -47,6 +54,37 @@ def get_sheets_logger():
     return _sheets_logger
 
 
+def _probe_camera() -> Tuple[bool, Optional[str]]:
+    """Probe the camera and cache the result."""
+    global _last_probe
+    _last_probe = microscope.test_camera()
+    return _last_probe
+
+
+def get_camera_status() -> Tuple[bool, Optional[str]]:
+    """
+    Return the cached camera status.
+    
+    Only _refresh_camera_probe re-probes, so a missing camera can't stall
+    a request while the controller tries to reopen it.
+    """
+    return _last_probe
+
+
+async def _refresh_camera_probe():
+    """Keep the camera probe fresh so request handlers never touch OpenCV."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(settings.camera_probe_interval_seconds)
+        # Don't fight an in-progress capture for the camera
+        if _capture_lock.locked():
+            continue
+        try:
+            await loop.run_in_executor(None, _probe_camera)
+        except Exception as e:
+            logger.warning(f"Camera probe failed: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events."""
@@ -58,8 +96,13 @@ async def lifespan(app: FastAPI):
     logger.info(f"Upload to Drive: {settings.upload_to_drive}")
     logger.info(f"Log to Sheets: {settings.log_to_sheets}")
     
-    # Test camera
-    success, error = microscope.test_camera()
+    # Compile the metrics kernels before the first capture needs them
+    from .image_metrics import warm_up
+    warm_up()
+    
+    # Open the camera now so the first request doesn't wait for it
+    microscope.warm()
+    success, error = _probe_camera()
     if success:
         logger.info("Microscope camera is available")
     else:
@@ -85,10 +128,19 @@ async def lifespan(app: FastAPI):
             else:
                 logger.warning(f"Google Sheets connection failed: {error}")
     
+    probe_task = asyncio.create_task(_refresh_camera_probe())
+    
     yield
     
     # Shutdown
     logger.info("Shutting down Microscope Runner service...")
+    probe_task.cancel()
+    microscope.close()
+    if _sheets_logger:
+        # Don't lose rows still waiting for the next batched append
+        _sheets_logger.flush()
+    if _drive_uploader:
+        _drive_uploader.close()
 
 
 app = FastAPI(
@@ -111,31 +163,30 @@ app.add_middleware(
 @app.get("/api/health", response_model=HealthResponse)
 async def health_check():
     """Check service health and camera availability."""
-    success, _ = microscope.test_camera()
+    success, _ = get_camera_status()
     
     return HealthResponse(
         status="healthy" if success else "degraded",
         port=settings.server_port,
         camera_available=success,
         camera_index=settings.camera_index,
-        is_busy=_is_busy
+        is_busy=_capture_lock.locked()
     )
 
 
 @app.get("/api/camera/test", response_model=CameraTestResponse)
 async def test_camera():
     """Test camera by capturing a test image."""
-    global _is_busy
-    
-    if _is_busy:
-        raise HTTPException(status_code=503, detail="Service is busy with another capture")
-    
-    _is_busy = True
-    try:
-        success, local_path, error = microscope.capture_test_image()
+    # Requests queue here rather than being rejected while the camera is in use
+    async with _capture_lock:
+        # OpenCV blocks; keep it off the event loop so /api/health stays responsive
+        loop = asyncio.get_running_loop()
+        success, local_path, error = await loop.run_in_executor(None, microscope.capture_test_image)
+        if success and await loop.run_in_executor(None, microscope.wait_for_write, local_path) is None:
+            success, error = False, "Failed to save test image"
         
         if success:
-            info = microscope.get_camera_info()
+            info = await loop.run_in_executor(None, microscope.get_camera_info)
             return CameraTestResponse(
                 success=True,
                 camera_index=settings.camera_index,
@@ -148,134 +199,169 @@ async def test_camera():
                 camera_index=settings.camera_index,
                 error=error
             )
-    finally:
-        _is_busy = False
+
+
+def _upload_and_log(
+    request: CaptureRequest,
+    local_path: str,
+    filename: str,
+    capture_id: Optional[str]
+):
+    """Upload, score and log a capture after the response is sent."""
+    # The image is encoded and saved off the request thread; wait for it
+    saved = microscope.wait_for_write(local_path)
+    if saved is None:
+        logger.error(f"Capture {local_path} was not saved, skipping upload and logging")
+        return
+    image_data, metrics = saved
+    
+    # 1. Upload to Google Drive
+    drive_file_id = None
+    drive_url = None
+    if settings.upload_to_drive:
+        uploader = get_drive_uploader()
+        if uploader:
+            upload_success, drive_file_id, drive_url = uploader.upload_image(local_path, filename, image_data)
+            if upload_success:
+                logger.info(f"Uploaded to Drive: {drive_file_id}")
+            else:
+                logger.warning("Drive upload failed, continuing without Drive")
+    
+    # 2. Image metrics, computed by the writer on the full-resolution frame
+    if metrics is None:
+        logger.warning(f"No metrics for {local_path}, logging without them")
+        metrics = {}
+    else:
+        logger.info(f"Computed metrics: composite={metrics.get('metric_composite')}")
+    
+    # 3. Log to Google Sheets (with metrics)
+    if settings.log_to_sheets:
+        sheets = get_sheets_logger()
+        if sheets:
+            log_success, capture_id = sheets.log_capture(
+                job_number=request.job_number,
+                local_path=local_path,
+                drive_file_id=drive_file_id,
+                drive_url=drive_url,
+                material_name=request.material_name,
+                parameters=request.parameters,
+                tuning_session_id=request.tuning_session_id,
+                iteration=request.iteration,
+                notes=request.notes,
+                metrics=metrics,
+                capture_id=capture_id
+            )
+            if log_success:
+                logger.info(f"Queued for sheet: {capture_id}")
+            else:
+                logger.warning("Sheet logging failed, continuing without logging")
 
 
 @app.post("/api/capture", response_model=CaptureResponse)
-async def capture_image(request: CaptureRequest):
+async def capture_image(request: CaptureRequest, background_tasks: BackgroundTasks):
     """Capture a microscope image for quality analysis.
     
     This endpoint:
     1. Captures image from microscope
-    2. Saves locally
+    2. Saves locally (encoded in the background)
+    
+    After the response is sent, a background task:
     3. Uploads to Google Drive (if enabled)
     4. Logs to Google Sheets (if enabled)
-    """
-    global _is_busy
     
-    if _is_busy:
-        raise HTTPException(status_code=503, detail="Service is busy with another capture")
-    
-    _is_busy = True
-    try:
-        logger.info(f"Capture request: job={request.job_number}, material={request.material_name}")
-        
-        # 1. Capture image
-        success, local_path, error = microscope.capture_image(
-            job_number=request.job_number,
-            parameter_set_id=request.parameter_set_id
-        )
-        
-        if not success:
+    drive_file_id and drive_url are therefore not included in the response.
+    """
+    # Requests queue here rather than being rejected while the camera is in use
+    async with _capture_lock:
+        try:
+            logger.info(f"Capture request: job={request.job_number}, material={request.material_name}")
+            
+            # 1. Capture image (one timestamp for the filename and the response)
+            # OpenCV blocks; keep it off the event loop so /api/health stays responsive
+            now = datetime.now()
+            loop = asyncio.get_running_loop()
+            success, local_path, error = await loop.run_in_executor(None, partial(
+                microscope.capture_image,
+                job_number=request.job_number,
+                parameter_set_id=request.parameter_set_id,
+                captured_at=now,
+                target_long_edge=request.target_long_edge,
+                with_metrics=True
+            ))
+            
+            if not success:
+                return CaptureResponse(
+                    success=False,
+                    job_number=request.job_number,
+                    error=error
+                )
+            
+            filename = Path(local_path).name if local_path else None
+            timestamp = now.isoformat()
+            
+            # Report the size actually saved, from the frame size the camera
+            # negotiated rather than the configured one
+            info = await loop.run_in_executor(None, microscope.get_camera_info)
+            resolution = None
+            if info.get("available"):
+                resolution = fit_long_edge((info["width"], info["height"]), request.target_long_edge)
+            
+            # Allocate the sheet row ID now so the caller gets it immediately
+            capture_id = None
+            if settings.log_to_sheets:
+                sheets = get_sheets_logger()
+                if sheets:
+                    capture_id = sheets.new_capture_id()
+            
+            # 3-4. Drive upload and Sheets logging don't need the camera
+            background_tasks.add_task(
+                _upload_and_log, request, local_path, filename, capture_id
+            )
+            
             return CaptureResponse(
-                success=False,
+                success=True,
                 job_number=request.job_number,
-                error=error
+                capture_id=capture_id,
+                local_path=local_path,
+                filename=filename,
+                capture_timestamp=timestamp,
+                resolution=resolution
             )
-        
-        filename = local_path.split("\\")[-1] if local_path else None
-        timestamp = datetime.now().isoformat()
-        
-        # 2. Upload to Google Drive
-        drive_file_id = None
-        drive_url = None
-        if settings.upload_to_drive:
-            uploader = get_drive_uploader()
-            if uploader:
-                upload_success, drive_file_id, drive_url = uploader.upload_image(local_path, filename)
-                if upload_success:
-                    logger.info(f"Uploaded to Drive: {drive_file_id}")
-                else:
-                    logger.warning("Drive upload failed, continuing without Drive")
-        
-        # 3. Compute image metrics
-        metrics = {}
-        try:
-            from .image_metrics import compute_metrics
-            metrics = compute_metrics(local_path)
-            logger.info(f"Computed metrics: composite={metrics.get('metric_composite')}")
+            
         except Exception as e:
-            logger.warning(f"Failed to compute metrics: {e}")
-        
-        # 4. Log to Google Sheets (with metrics)
-        capture_id = None
-        if settings.log_to_sheets:
-            sheets = get_sheets_logger()
-            if sheets:
-                log_success, capture_id = sheets.log_capture(
-                    job_number=request.job_number,
-                    local_path=local_path,
-                    drive_file_id=drive_file_id,
-                    drive_url=drive_url,
-                    material_name=request.material_name,
-                    parameters=request.parameters,
-                    tuning_session_id=request.tuning_session_id,
-                    iteration=request.iteration,
-                    notes=request.notes,
-                    metrics=metrics
-                )
-                if log_success:
-                    logger.info(f"Logged to sheet: {capture_id}")
-                else:
-                    logger.warning("Sheet logging failed, continuing without logging")
-        
-        return CaptureResponse(
-            success=True,
-            job_number=request.job_number,
-            capture_id=capture_id,
-            local_path=local_path,
-            filename=filename,
-            drive_file_id=drive_file_id,
-            drive_url=drive_url,
-            capture_timestamp=timestamp,
-            resolution=microscope.resolution
-        )
-        
-    except Exception as e:
-        logger.error(f"Capture failed: {e}")
-        return CaptureResponse(
-            success=False,
-            job_number=request.job_number,
-            error=str(e)
-        )
-    finally:
-        _is_busy = False
+            logger.error(f"Capture failed: {e}")
+            return CaptureResponse(
+                success=False,
+                job_number=request.job_number,
+                error=str(e)
+            )
 
 
 @app.get("/api/camera/info")
 async def camera_info():
     """Get camera information."""
-    return microscope.get_camera_info()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, microscope.get_camera_info)
 
 
 @app.get("/api/status")
 async def status():
     """Get detailed service status."""
-    camera_ok, camera_error = microscope.test_camera()
+    loop = asyncio.get_running_loop()
     
-    drive_ok = False
-    sheets_ok = False
+    async def not_checked() -> Tuple[bool, Optional[str]]:
+        return False, None
     
-    if settings.upload_to_drive:
-        uploader = get_drive_uploader()
-        if uploader:
-            drive_ok, _ = uploader.test_connection()
+    uploader = get_drive_uploader() if settings.upload_to_drive else None
+    sheets = get_sheets_logger() if settings.log_to_sheets else None
     
-    if settings.log_to_sheets:
-        sheets = get_sheets_logger()
-        if sheets:
-            sheets_ok, _ = sheets.test_connection()
+    camera_ok, camera_error = get_camera_status()
+    
+    # Probe Drive and Sheets concurrently, off the event loop
+    (drive_ok, _), (sheets_ok, _) = await asyncio.gather(
+        loop.run_in_executor(None, uploader.test_connection) if uploader else not_checked(),
+        loop.run_in_executor(None, sheets.test_connection) if sheets else not_checked()
+    )
     
     return {
         "service": "Microscope Runner",
@@ -295,5 +381,5 @@ async def status():
             "connected": sheets_ok,
             "spreadsheet_id": settings.sheets_spreadsheet_id if settings.log_to_sheets else None
         },
-        "is_busy": _is_busy
+        "is_busy": _capture_lock.locked()
     }
@@ -14,10 +14,28 @@ class Settings(BaseSettings):
     
     # Camera
     camera_index: int = Field(default=1, alias="CAMERA_INDEX")
+    # OpenCV capture backend name (DSHOW, MSMF, V4L2, GSTREAMER, ANY, ...);
+    # AUTO uses DirectShow on Windows, a GStreamer pipeline (if OpenCV was
+    # built with it) or V4L2 on Linux, and lets OpenCV choose elsewhere
+    camera_backend: str = Field(default="AUTO", alias="CAMERA_BACKEND")
     camera_resolution_width: int = Field(default=1920, alias="CAMERA_RESOLUTION_WIDTH")
     camera_resolution_height: int = Field(default=1080, alias="CAMERA_RESOLUTION_HEIGHT")
+    # Pixel format requested from the camera; MJPG keeps 1080p within USB 2.0
+    # bandwidth. Set to YUYV for cameras that misreport MJPG, or empty for
+    # the driver default.
+    camera_fourcc: str = Field(default="MJPG", alias="CAMERA_FOURCC")
     capture_format: str = Field(default="jpg", alias="CAPTURE_FORMAT")
     capture_quality: int = Field(default=95, alias="CAPTURE_QUALITY")
+    # Progressive JPEGs are ~5% smaller to upload but slower to encode/decode
+    capture_progressive: bool = Field(default=True, alias="CAPTURE_PROGRESSIVE")
+    # Encoder for saved captures: "cv2", or "pyvips" (needs libvips)
+    save_backend: str = Field(default="cv2", alias="SAVE_BACKEND")
+    # Also save the full-resolution frame (as *_full.jpg) when a capture
+    # asks for a smaller target_long_edge
+    keep_full_res: bool = Field(default=False, alias="KEEP_FULL_RES")
+    # OpenCV worker threads; unset uses half the logical CPUs so encoding
+    # doesn't oversubscribe small hosts alongside uvicorn
+    cv_threads: Optional[int] = Field(default=None, alias="CV_THREADS")
     
     # Storage
     local_storage_path: str = Field(
@@ -31,6 +49,7 @@ class Settings(BaseSettings):
     
     # Timeouts
     camera_timeout_seconds: int = Field(default=10, alias="CAMERA_TIMEOUT_SECONDS")
+    camera_probe_interval_seconds: float = Field(default=5.0, alias="CAMERA_PROBE_INTERVAL_SECONDS")
     
     # Google Drive settings
     drive_credentials_path: str = Field(
@@ -47,6 +66,10 @@ class Settings(BaseSettings):
         default="1aAIVfx6EfBmH8g3Zny5JXch079g3IM9fogNtzLH1tJk",
         alias="SHEETS_SPREADSHEET_ID"
     )
+    # Capture rows are appended in one request once this many are queued,
+    # or after the interval (seconds), whichever comes first
+    sheets_batch_size: int = Field(default=50, alias="SHEETS_BATCH_SIZE")
+    sheets_flush_interval: float = Field(default=5.0, alias="SHEETS_FLUSH_INTERVAL")
     
     # Feature flags
     upload_to_drive: bool = Field(default=True, alias="UPLOAD_TO_DRIVE")
@@ -1,18 +1,60 @@
 """Google Drive upload functionality for microscope captures."""
 
+import json
 import logging
+import os
+import threading
+import uuid
+from concurrent.futures import Future
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
+import httpx
+from google.auth.transport.requests import Request as AuthRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaInMemoryUpload
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 from .config import settings
+from .google_http import authorized_http
 
 logger = logging.getLogger(__name__)
 
+# Files above this size use a resumable session through googleapiclient;
+# smaller ones go up in a single multipart request on the pooled HTTP/2 client
+RESUMABLE_THRESHOLD_BYTES = 5 * 1024 * 1024
+
+UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+
+# HTTP statuses Drive returns for rate limiting and transient server errors
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Whether a Drive API error is worth retrying."""
+    if isinstance(error, HttpError):
+        return error.resp.status in TRANSIENT_STATUSES
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in TRANSIENT_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+
+_retry_transient = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(min=2, max=60),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+
+
+@_retry_transient
+def _execute(request):
+    """Execute a Drive API request, retrying transient failures with backoff."""
+    return request.execute()
+
 
 class DriveUploader:
     """Handles uploading microscope images to Google Drive."""
@@ -20,26 +62,112 @@ class DriveUploader:
     def __init__(self):
         self.credentials_path = settings.drive_credentials_path
         self.captures_folder_id = settings.drive_captures_folder_id
+        self._credentials = None
         self._service = None
+        self._http: Optional[httpx.Client] = None
+        self._token_lock = threading.Lock()
+        # Guards lazy setup and the month cache only; never held across a
+        # network call, since uploads run concurrently in background tasks
+        self._lock = threading.Lock()
+        self._month_cache: Dict[str, Future] = {}  # month name -> folder ID
+    
+    def _get_credentials(self):
+        """Get or load the service account credentials."""
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_path,
+                    scopes=['https://www.googleapis.com/auth/drive.file']
+                )
+            return self._credentials
     
     def _get_service(self):
         """Get or create the Drive service."""
-        if self._service is None:
-            creds = service_account.Credentials.from_service_account_file(
-                self.credentials_path,
-                scopes=['https://www.googleapis.com/auth/drive.file']
+        creds = self._get_credentials()
+        with self._lock:
+            if self._service is None:
+                # A pooled, thread-safe transport instead of httplib2, so
+                # concurrent uploads can share the service
+                self._service = build('drive', 'v3', http=authorized_http(creds))
+            return self._service
+    
+    def _get_http(self) -> httpx.Client:
+        """Get or create the pooled HTTP/2 client used for uploads."""
+        with self._lock:
+            if self._http is None:
+                self._http = httpx.Client(http2=True, timeout=30)
+            return self._http
+    
+    def _access_token(self, force_refresh: bool = False) -> str:
+        """Return a valid OAuth access token, refreshing it if needed."""
+        with self._token_lock:
+            creds = self._get_credentials()
+            if force_refresh or not creds.valid:
+                creds.refresh(AuthRequest())
+            return creds.token
+    
+    @_retry_transient
+    def _upload_multipart(self, data: bytes, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Upload a file as a single multipart/related request."""
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f'--{boundary}\r\n'.encode(),
+            b'Content-Type: application/json; charset=UTF-8\r\n\r\n',
+            json.dumps(metadata).encode(),
+            f'\r\n--{boundary}\r\n'.encode(),
+            b'Content-Type: image/jpeg\r\n\r\n',
+            data,
+            f'\r\n--{boundary}--\r\n'.encode(),
+        ])
+        
+        # Retry once with a fresh token if the cached one was rejected
+        for force_refresh in (False, True):
+            response = self._get_http().post(
+                UPLOAD_URL,
+                params={'uploadType': 'multipart', 'fields': 'id, webViewLink'},
+                headers={
+                    'Authorization': f'Bearer {self._access_token(force_refresh)}',
+                    'Content-Type': f'multipart/related; boundary={boundary}'
+                },
+                content=body
             )
-            self._service = build('drive', 'v3', credentials=creds)
-        return self._service
+            if response.status_code != 401:
+                break
+        
+        response.raise_for_status()
+        return response.json()
     
     def _get_or_create_month_folder(self) -> str:
         """Get or create the current month's subfolder."""
-        service = self._get_service()
         month_name = datetime.now().strftime('%Y-%m')
         
+        # The first upload of the month looks the folder up; concurrent ones
+        # wait on its result instead of creating duplicate folders
+        with self._lock:
+            pending = self._month_cache.get(month_name)
+            owner = pending is None
+            if owner:
+                pending = self._month_cache[month_name] = Future()
+        if not owner:
+            return pending.result()
+        
+        try:
+            folder_id = self._find_or_create_folder(month_name)
+        except Exception as e:
+            with self._lock:
+                del self._month_cache[month_name]
+            pending.set_exception(e)
+            raise
+        pending.set_result(folder_id)
+        return folder_id
+    
+    def _find_or_create_folder(self, month_name: str) -> str:
+        """Look up a month folder on Drive, creating it if missing."""
+        service = self._get_service()
+        
         # Check if month folder exists
         query = f"name='{month_name}' and '{self.captures_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        results = service.files().list(q=query, fields='files(id)').execute()
+        results = _execute(service.files().list(q=query, fields='files(id)'))
         files = results.get('files', [])
         
         if files:
@@ -51,20 +179,26 @@ class DriveUploader:
             'mimeType': 'application/vnd.google-apps.folder',
             'parents': [self.captures_folder_id]
         }
-        folder = service.files().create(body=metadata, fields='id').execute()
+        folder = _execute(service.files().create(body=metadata, fields='id'))
         logger.info(f"Created month folder: {month_name}")
         return folder['id']
     
-    def upload_image(self, local_path: str, filename: str) -> Tuple[bool, Optional[str], Optional[str]]:
+    def upload_image(
+        self,
+        local_path: str,
+        filename: str,
+        data: Optional[bytes] = None
+    ) -> Tuple[bool, Optional[str], Optional[str]]:
         """
         Upload an image to Google Drive.
         
+        If the encoded image is already in memory, pass it as data to
+        upload it directly instead of re-reading local_path.
+        
         Returns:
             Tuple of (success, file_id, web_view_link)
         """
         try:
-            service = self._get_service()
-            
             # Get the month folder
             parent_folder_id = self._get_or_create_month_folder()
             
@@ -74,17 +208,22 @@ class DriveUploader:
                 'parents': [parent_folder_id]
             }
             
-            media = MediaFileUpload(
-                local_path,
-                mimetype='image/jpeg',
-                resumable=True
-            )
-            
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webViewLink'
-            ).execute()
+            size = len(data) if data is not None else os.path.getsize(local_path)
+            if size <= RESUMABLE_THRESHOLD_BYTES:
+                if data is None:
+                    data = Path(local_path).read_bytes()
+                file = self._upload_multipart(data, file_metadata)
+            else:
+                if data is not None:
+                    media = MediaInMemoryUpload(data, mimetype='image/jpeg', resumable=True)
+                else:
+                    media = MediaFileUpload(local_path, mimetype='image/jpeg', resumable=True)
+                
+                file = _execute(self._get_service().files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    fields='id, webViewLink'
+                ))
             
             file_id = file.get('id')
             web_link = file.get('webViewLink')
@@ -110,6 +249,16 @@ class DriveUploader:
         except Exception as e:
             logger.error(f"Drive connection failed: {e}")
             return False, str(e)
+    
+    def close(self):
+        """Close the upload client and the Drive service's pooled connections."""
+        with self._lock:
+            http, self._http = self._http, None
+            service, self._service = self._service, None
+        if http is not None:
+            http.close()
+        if service is not None:
+            service.close()
 
 
 # Global instance
@@ -0,0 +1,39 @@
+"""Shared HTTP transport for the Google API clients."""
+
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+# Connections kept open per API client
+POOL_SIZE = 4
+REQUEST_TIMEOUT_SECONDS = 30
+
+
+class SessionHttp:
+    """
+    httplib2.Http stand-in that sends googleapiclient requests through a
+    pooled AuthorizedSession. Unlike httplib2, it is safe to share between
+    threads, and requests reuse open connections.
+    """
+    
+    def __init__(self, session: AuthorizedSession):
+        self.session = session
+    
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        response = self.session.request(
+            method, uri, data=body, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS
+        )
+        info = dict(response.headers)
+        info['status'] = response.status_code
+        return httplib2.Response(info), response.content
+    
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+
+def authorized_http(credentials) -> SessionHttp:
+    """Build a pooled, thread-safe transport for googleapiclient.discovery.build(http=...)."""
+    session = AuthorizedSession(credentials)
+    session.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+    return SessionHttp(session)
@@ -1,45 +1,338 @@
 """Microscope capture controller using OpenCV."""
 
+import atexit
 import cv2
 import logging
+import numpy as np
 import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import pyvips
+except (ImportError, OSError):  # pyvips is optional and needs libvips
+    pyvips = None
 
 from .config import settings
+from .image_metrics import compute_metrics_from_array
 
 logger = logging.getLogger(__name__)
 
+# Consecutive failed grabs before the grabber gives up on the handle
+MAX_GRAB_FAILURES = 30
+
+# Decoded frame buffers kept for the grabber to decode into again
+MAX_SPARE_FRAMES = 2
+
+# Finished writes kept around for wait_for_write() before being dropped
+MAX_TRACKED_WRITES = 16
+
+
+@lru_cache(maxsize=None)
+def _gstreamer_available() -> bool:
+    """Whether this OpenCV build includes the GStreamer backend."""
+    for line in cv2.getBuildInformation().splitlines():
+        if line.strip().startswith("GStreamer:"):
+            return "YES" in line
+    return False
+
+
+def _resolve_backend(name: str) -> int:
+    """
+    Map a backend name from settings to an OpenCV CAP_* constant for opening
+    the camera by index. GSTREAMER is opened through a pipeline instead (see
+    MicroscopeController._open_capture) and falls back like AUTO.
+    """
+    name = name.upper()
+    if name in ("AUTO", "GSTREAMER"):
+        # DirectShow opens far faster than MSMF on Windows; on Linux go
+        # straight to V4L2 rather than letting OpenCV try GStreamer/FFmpeg
+        if os.name == "nt":
+            return cv2.CAP_DSHOW
+        if sys.platform.startswith("linux"):
+            return cv2.CAP_V4L2
+        return cv2.CAP_ANY
+    backend = getattr(cv2, f"CAP_{name}", None)
+    if backend is None:
+        logger.warning(f"Unknown camera backend {name!r}, using CAP_ANY")
+        return cv2.CAP_ANY
+    return backend
+
+
+def fit_long_edge(size: Tuple[int, int], long_edge: Optional[int]) -> Tuple[int, int]:
+    """Scale (width, height) down so the longer side is at most long_edge."""
+    width, height = size
+    if long_edge is None or long_edge <= 0 or max(width, height) <= long_edge:
+        return width, height
+    scale = long_edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
 
 class MicroscopeController:
     """Controls the WA5202 USB microscope for image capture."""
     
     def __init__(self):
         self.camera_index = settings.camera_index
+        self.backend = _resolve_backend(settings.camera_backend)
+        # On Linux, a GStreamer appsink with drop=true max-buffers=1 always
+        # hands back the newest frame, whatever the driver's queue depth
+        self.use_gstreamer = (
+            settings.camera_backend.upper() == "GSTREAMER"
+            or (settings.camera_backend.upper() == "AUTO" and sys.platform.startswith("linux"))
+        ) and _gstreamer_available()
         self.resolution = (
             settings.camera_resolution_width,
             settings.camera_resolution_height
         )
+        self.fourcc = settings.camera_fourcc.strip().upper()
         self.capture_format = settings.capture_format
         self.capture_quality = settings.capture_quality
+        self.capture_progressive = settings.capture_progressive
+        self.keep_full_res = settings.keep_full_res
+        self.save_backend = settings.save_backend.lower()
+        if self.save_backend == "pyvips" and pyvips is None:
+            logger.warning("pyvips is not available, saving captures with OpenCV")
+            self.save_backend = "cv2"
         self.storage_path = settings.local_storage_path
+        self.frame_timeout = settings.camera_timeout_seconds
         self._camera: Optional[cv2.VideoCapture] = None
+        self._info: Optional[dict] = None  # properties read when the camera opened
+        self._lock = threading.Lock()
+        
+        # Background grabber state. The grabber only decodes a frame when one
+        # is wanted; otherwise it just grab()s to keep the driver queue fresh.
+        self._grabber: Optional[threading.Thread] = None
+        self._stop = threading.Event()  # each grabber gets its own stop event
+        self._frame_lock = threading.Lock()
+        self._latest: Optional[np.ndarray] = None
+        self._frame_wanted = threading.Event()
+        self._new_frame = threading.Event()
+        self._last_grab = 0.0  # monotonic time of the last successful grab
+        # A decoded frame belongs to whoever takes it until it is recycled
+        self._spare_frames: List[np.ndarray] = []
+        
+        # Encode and disk write run on one worker so the request returns as
+        # soon as the frame is grabbed. Futures resolve to (bytes, metrics).
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="microscope-writer")
+        self._writes: Dict[str, Future] = {}
+        self._writes_lock = threading.Lock()
         
         # Ensure storage directory exists
         os.makedirs(self.storage_path, exist_ok=True)
+        
+        # Release the camera handle when the process exits
+        atexit.register(self.close)
+    
+    def _ensure_open(self) -> Optional[cv2.VideoCapture]:
+        """
+        Return the persistent camera handle, opening it and starting the
+        grabber thread if needed.
+        
+        Must be called with self._lock held.
+        """
+        if (self._camera is not None and self._grabber is not None
+                and self._grabber.is_alive() and not self._stop.is_set()):
+            return self._camera
+        if not self._release():
+            return None
+        
+        camera = self._open_capture()
+        if not camera.isOpened():
+            camera.release()
+            return None
+        
+        # Keep only the newest frame in the driver queue
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        
+        # Warm-up frames (let camera adjust exposure); grab() skips decoding
+        logger.info("Warming up camera...")
+        for _ in range(10):
+            if camera.grab():
+                self._last_grab = time.monotonic()
+        
+        self._camera = camera
+        self._info = {
+            "index": self.camera_index,
+            "width": int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "fps": camera.get(cv2.CAP_PROP_FPS),
+        }
+        self._stop = threading.Event()
+        self._grabber = threading.Thread(
+            target=self._pump,
+            args=(camera, self._stop),
+            name="microscope-grabber",
+            daemon=True
+        )
+        self._grabber.start()
+        return camera
+    
+    def _gstreamer_pipeline(self) -> str:
+        """Build a one-frame-latency GStreamer pipeline for the camera."""
+        width, height = self.resolution
+        if self.fourcc == "MJPG":
+            source_caps = f"image/jpeg,width={width},height={height} ! jpegdec"
+        else:
+            source_caps = f"video/x-raw,width={width},height={height}"
+        return (
+            f"v4l2src device=/dev/video{self.camera_index} ! {source_caps} ! "
+            "videoconvert ! video/x-raw,format=BGR ! "
+            "appsink drop=true max-buffers=1 sync=false"
+        )
+    
+    def _open_capture(self) -> cv2.VideoCapture:
+        """Open the camera, preferring the GStreamer pipeline when enabled."""
+        if self.use_gstreamer:
+            camera = cv2.VideoCapture(self._gstreamer_pipeline(), cv2.CAP_GSTREAMER)
+            if camera.isOpened():
+                return camera
+            camera.release()
+            logger.warning("GStreamer pipeline failed to open, falling back to device index")
+        
+        # Pass format in the open call so the driver doesn't reopen on set().
+        # FOURCC goes first: some drivers only offer full resolution in MJPG.
+        params = []
+        if self.fourcc:
+            params += [cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc)]
+        params += [
+            cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0],
+            cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1],
+        ]
+        return cv2.VideoCapture(self.camera_index, self.backend, params)
+    
+    def _pump(self, camera: cv2.VideoCapture, stop: threading.Event):
+        """Grabber thread: keep grabbing frames, decoding only those asked for."""
+        failures = 0
+        while not stop.is_set():
+            # Checked before grab() so a wanted frame is always exposed after
+            # the request was made
+            wanted = self._frame_wanted.is_set()
+            
+            if not camera.grab():
+                failures += 1
+                if failures >= MAX_GRAB_FAILURES:
+                    logger.error("Camera stopped delivering frames")
+                    break
+                continue
+            failures = 0
+            self._last_grab = time.monotonic()
+            
+            if not wanted:
+                continue
+            
+            # Decode into a recycled buffer instead of allocating one per frame
+            with self._frame_lock:
+                spare = self._spare_frames.pop() if self._spare_frames else None
+            if spare is not None:
+                ret, frame = camera.retrieve(spare)
+            else:
+                ret, frame = camera.retrieve()
+            if not ret or frame is None:
+                self._recycle_frame(spare)
+                continue
+            
+            with self._frame_lock:
+                # A stopped grabber must not publish into a newer camera's state
+                if stop.is_set():
+                    break
+                # A frame nobody took (its request timed out) can be reused
+                if self._latest is not None and len(self._spare_frames) < MAX_SPARE_FRAMES:
+                    self._spare_frames.append(self._latest)
+                self._latest = frame
+                self._frame_wanted.clear()
+                self._new_frame.set()
+    
+    def _release(self) -> bool:
+        """
+        Stop the grabber and drop the camera handle. Lock must be held.
+        
+        Returns False, keeping the handle, if the grabber is still running
+        (stuck in grab()); releasing the camera under it is unsafe.
+        """
+        self._stop.set()
+        if self._grabber is not None:
+            self._grabber.join(timeout=self.frame_timeout)
+            if self._grabber.is_alive():
+                logger.error("Camera grabber did not stop within %ss, camera unavailable", self.frame_timeout)
+                return False
+            self._grabber = None
+        if self._camera is not None:
+            self._camera.release()
+            self._camera = None
+        self._info = None
+        with self._frame_lock:
+            self._latest = None
+            self._spare_frames.clear()
+            self._frame_wanted.clear()
+            self._new_frame.clear()
+        return True
+    
+    def _open_error(self) -> str:
+        """Explain why _ensure_open() returned None."""
+        if self._grabber is not None and self._grabber.is_alive():
+            return "Previous camera grabber has not stopped yet"
+        return f"Cannot open camera at index {self.camera_index}"
+    
+    def warm(self) -> bool:
+        """Open the camera ahead of the first request."""
+        with self._lock:
+            return self._ensure_open() is not None
+    
+    def close(self):
+        """Stop the grabber, release the camera and finish pending writes."""
+        with self._lock:
+            self._release()
+        with self._writes_lock:
+            pending = list(self._writes.values())
+        wait(pending)
+    
+    def _get_frame(self, require_new: bool = True) -> Optional[np.ndarray]:
+        """
+        Take a decoded frame from the grabber.
+        
+        With require_new, wait for a frame grabbed after this call rather
+        than taking one already decoded. The caller owns the returned
+        frame; hand it to _recycle_frame() once done with it.
+        """
+        with self._lock:
+            if self._ensure_open() is None:
+                return None
+        
+        with self._frame_lock:
+            if not require_new and self._latest is not None:
+                frame, self._latest = self._latest, None
+                return frame
+            self._new_frame.clear()
+            self._frame_wanted.set()
+        
+        if not self._new_frame.wait(timeout=self.frame_timeout):
+            return None
+        with self._frame_lock:
+            frame, self._latest = self._latest, None
+            return frame
+    
+    def _recycle_frame(self, frame: Optional[np.ndarray]):
+        """Give a frame buffer back to the grabber for reuse."""
+        if frame is None:
+            return
+        with self._frame_lock:
+            if len(self._spare_frames) < MAX_SPARE_FRAMES:
+                self._spare_frames.append(frame)
     
     def test_camera(self) -> Tuple[bool, Optional[str]]:
         """Test if the microscope camera is available."""
         try:
-            camera = cv2.VideoCapture(self.camera_index)
-            if not camera.isOpened():
-                return False, f"Cannot open camera at index {self.camera_index}"
+            with self._lock:
+                if self._ensure_open() is None:
+                    return False, self._open_error()
             
-            # Try to read a frame
-            ret, frame = camera.read()
-            camera.release()
-            
-            if not ret or frame is None:
+            # A recent successful grab proves the camera is delivering
+            if time.monotonic() - self._last_grab > self.frame_timeout:
                 return False, "Camera opened but failed to capture frame"
             
             return True, None
@@ -49,39 +342,41 @@ class MicroscopeController:
     def capture_image(
         self,
         job_number: str,
-        parameter_set_id: Optional[str] = None
+        parameter_set_id: Optional[str] = None,
+        require_new: bool = True,
+        captured_at: Optional[datetime] = None,
+        target_long_edge: Optional[int] = None,
+        with_metrics: bool = False
     ) -> Tuple[bool, Optional[str], Optional[str]]:
         """
         Capture an image from the microscope.
         
+        The frame is encoded and saved in the background; the returned path
+        may not exist yet. Use wait_for_write() before reading it.
+        
+        Args:
+            job_number: Job the capture belongs to
+            parameter_set_id: Optional parameter set, included in the filename
+            require_new: Wait for a frame grabbed after this call instead of
+                taking one already decoded
+            captured_at: Timestamp for the filename, so callers can report
+                the same time; defaults to now
+            target_long_edge: Downscale so the longer side is at most this
+                many pixels before encoding
+            with_metrics: Also compute quality metrics, on the full-resolution
+                frame since SHARPNESS_NORM is calibrated at that scale
+        
         Returns:
             Tuple of (success, local_path, error_message)
         """
         try:
-            # Open camera (auto backend)
-            camera = cv2.VideoCapture(self.camera_index)
-            
-            if not camera.isOpened():
-                return False, None, f"Cannot open camera at index {self.camera_index}"
-            
-            # Set resolution
-            camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
-            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
-            
-            # Warm-up frames (let camera adjust exposure)
-            logger.info("Warming up camera...")
-            for _ in range(10):
-                camera.read()
-            
-            # Capture frame
-            ret, frame = camera.read()
-            camera.release()
-            
-            if not ret or frame is None:
+            frame = self._get_frame(require_new=require_new)
+            if frame is None:
                 return False, None, "Failed to capture frame"
             
-            # Generate filename
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            # Generate filename; milliseconds keep burst captures from colliding
+            when = captured_at or datetime.now()
+            timestamp = f"{when:%Y%m%d_%H%M%S}_{when.microsecond // 1000:03d}"
             if parameter_set_id:
                 filename = f"micro_{job_number}_{parameter_set_id}_{timestamp}.{self.capture_format}"
             else:
@@ -89,11 +384,13 @@ class MicroscopeController:
             
             local_path = os.path.join(self.storage_path, filename)
             
-            # Save image
-            if self.capture_format.lower() in ['jpg', 'jpeg']:
-                cv2.imwrite(local_path, frame, [cv2.IMWRITE_JPEG_QUALITY, self.capture_quality])
-            else:
-                cv2.imwrite(local_path, frame)
+            future = self._writer.submit(
+                self._encode_and_write, frame, local_path, self.capture_quality,
+                target_long_edge, with_metrics
+            )
+            with self._writes_lock:
+                self._writes[local_path] = future
+                self._prune_writes()
             
             logger.info(f"Captured image: {local_path}")
             return True, local_path, None
@@ -102,27 +399,124 @@ class MicroscopeController:
             logger.error(f"Capture error: {e}")
             return False, None, str(e)
     
+    def _encode_and_write(
+        self,
+        frame: np.ndarray,
+        local_path: str,
+        quality: int,
+        target_long_edge: Optional[int] = None,
+        with_metrics: bool = False
+    ) -> Tuple[bytes, Optional[Dict[str, Any]]]:
+        """Writer thread: score the frame if asked, then encode it once (downscaled if asked) and save it."""
+        metrics = None
+        try:
+            if with_metrics:
+                metrics = compute_metrics_from_array(frame)
+            full_size = (frame.shape[1], frame.shape[0])
+            size = fit_long_edge(full_size, target_long_edge)
+            if size == full_size:
+                data = self._encode(frame, quality)
+            else:
+                if self.keep_full_res:
+                    root, ext = os.path.splitext(local_path)
+                    self._write_file(f"{root}_full{ext}", self._encode(frame, quality))
+                # INTER_AREA averages source pixels, avoiding moire when shrinking
+                data = self._encode(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), quality)
+        finally:
+            self._recycle_frame(frame)
+        
+        self._write_file(local_path, data)
+        return data, metrics
+    
+    def _write_file(self, path: str, data: bytes):
+        """Write encoded bytes with a raw, unbuffered write."""
+        # O_BINARY keeps Windows from translating bytes
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        
+        logger.info(f"Saved image: {path}")
+    
+    def _encode(self, frame: np.ndarray, quality: int) -> bytes:
+        """Encode a BGR frame in the capture format with the configured backend."""
+        is_jpeg = self.capture_format.lower() in ['jpg', 'jpeg']
+        
+        if self.save_backend == "pyvips":
+            height, width = frame.shape[:2]
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            image = pyvips.Image.new_from_memory(rgb.data, width, height, 3, 'uchar')
+            if is_jpeg:
+                return image.write_to_buffer(
+                    '.jpg',
+                    Q=quality,
+                    optimize_coding=True,
+                    interlace=self.capture_progressive,
+                    strip=True
+                )
+            return image.write_to_buffer(f'.{self.capture_format}')
+        
+        if is_jpeg:
+            # Optimized Huffman tables shrink the file at no quality cost.
+            # Flags must be ints: OpenCV rejects bools here.
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            if self.capture_progressive:
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+            ok, encoded = cv2.imencode('.jpg', frame, params)
+        else:
+            ok, encoded = cv2.imencode(f'.{self.capture_format}', frame)
+        if not ok:
+            raise RuntimeError("Failed to encode image")
+        return encoded.tobytes()
+    
+    def _prune_writes(self):
+        """Forget the oldest finished writes. Writes lock must be held."""
+        excess = len(self._writes) - MAX_TRACKED_WRITES
+        for path in [p for p, f in self._writes.items() if f.done()][:max(excess, 0)]:
+            del self._writes[path]
+    
+    def wait_for_write(
+        self,
+        local_path: str,
+        timeout: Optional[float] = None
+    ) -> Optional[Tuple[bytes, Optional[Dict[str, Any]]]]:
+        """
+        Block until a capture is on disk.
+        
+        Returns:
+            Tuple of (encoded image bytes, full-resolution metrics or None if
+            not requested), or None if encoding or saving failed
+        """
+        with self._writes_lock:
+            future = self._writes.pop(local_path, None)
+        
+        try:
+            if future is not None:
+                return future.result(timeout=timeout)
+            # Already forgotten (or written by another process): read it back
+            with open(local_path, 'rb') as f:
+                return f.read(), None
+        except Exception as e:
+            logger.error(f"Failed to save {local_path}: {e}")
+            return None
+    
     def capture_test_image(self) -> Tuple[bool, Optional[str], Optional[str]]:
         """Capture a test image to verify camera is working."""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return self.capture_image(f"test_{timestamp}")
+        now = datetime.now()
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
+        return self.capture_image(f"test_{timestamp}", captured_at=now)
     
     def get_camera_info(self) -> dict:
-        """Get information about the camera."""
+        """Get information about the camera, as read when it was opened."""
         try:
-            camera = cv2.VideoCapture(self.camera_index)
-            if not camera.isOpened():
-                return {"available": False, "error": "Cannot open camera"}
-            
-            info = {
-                "available": True,
-                "index": self.camera_index,
-                "width": int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                "height": int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                "fps": camera.get(cv2.CAP_PROP_FPS),
-            }
-            camera.release()
-            return info
+            with self._lock:
+                if self._ensure_open() is None:
+                    return {"available": False, "error": self._open_error()}
+                
+                return {"available": True, **self._info}
         except Exception as e:
             return {"available": False, "error": str(e)}
 
@@ -10,10 +10,11 @@ class CaptureRequest(BaseModel):
     job_number: str
     parameter_set_id: Optional[str] = None
     material_name: Optional[str] = None
-    parameters: Optional[dict] = None  # Laser parameters for logging
+    parameters: Optional[dict[str, float]] = None  # Laser parameters for logging
     tuning_session_id: Optional[str] = None
     iteration: Optional[int] = None
     notes: Optional[str] = None
+    target_long_edge: Optional[int] = None  # Downscale so the longer side is at most this
 
 
 class CaptureResponse(BaseModel):
@@ -26,7 +27,7 @@ class CaptureResponse(BaseModel):
     drive_file_id: Optional[str] = None
     drive_url: Optional[str] = None
     capture_timestamp: Optional[str] = None
-    resolution: Optional[tuple] = None
+    resolution: Optional[tuple[int, int]] = None
     error: Optional[str] = None
 
 
@@ -44,6 +45,6 @@ class CameraTestResponse(BaseModel):
     """Camera test response."""
     success: bool
     camera_index: int
-    resolution: Optional[tuple] = None
+    resolution: Optional[tuple[int, int]] = None
     test_image_path: Optional[str] = None
     error: Optional[str] = None
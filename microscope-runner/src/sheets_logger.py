@@ -1,17 +1,76 @@
 """Google Sheets logging for microscope captures."""
 
+import itertools
 import logging
-import uuid
+import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, List, Tuple
 
+import requests
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 from .config import settings
+from .google_http import authorized_http
 
 logger = logging.getLogger(__name__)
 
+# Laser parameters logged per capture, in sheet order (columns H-N)
+PARAM_COLUMNS = (
+    'feedRate_mm_min',
+    'minPower_pct',
+    'maxPower_pct',
+    'quality',
+    'whiteClip',
+    'contrast',
+    'brightness',
+)
+
+# Score and metric columns (O-R). manual_score is filled in by a human later.
+METRIC_COLUMNS = {
+    'manual_score': 'O',
+    'metric_contrast': 'P',
+    'metric_sharpness': 'Q',
+    'metric_composite': 'R',
+}
+
+# HTTP statuses Sheets returns for quota limits and transient server errors
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+# Failed flushes in a row before queued rows are given up on
+MAX_FLUSH_FAILURES = 5
+
+# Recently appended rows remembered for update_metrics
+MAX_CACHED_ROWS = 1000
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Whether a Sheets API error is worth retrying."""
+    if isinstance(error, HttpError):
+        return error.resp.status in TRANSIENT_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(min=1, max=10),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+def _execute(request):
+    """Execute a Sheets API request, retrying transient failures with backoff."""
+    return request.execute()
+
+
+# One Sheets service per process, shared by every SheetsLogger
+_service = None
+_service_lock = threading.Lock()
+
 
 class SheetsLogger:
     """Logs microscope capture data to Google Sheets."""
@@ -20,17 +79,43 @@ class SheetsLogger:
         self.credentials_path = settings.drive_credentials_path
         self.spreadsheet_id = settings.sheets_spreadsheet_id
         self.sheet_name = 'Microscope_Captures'
-        self._service = None
+        self.batch_size = max(settings.sheets_batch_size, 1)
+        self.flush_interval = settings.sheets_flush_interval
+        
+        # Capture IDs count up from the start time in milliseconds, so they
+        # stay unique within a run and don't restart at the same value
+        self._capture_ids = itertools.count(time.time_ns() // 1_000_000)
+        
+        # Rows waiting to be appended, and the thread that flushes them
+        self._pending: List[list] = []
+        self._pending_lock = threading.Lock()
+        self._append_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._flush_failures = 0
+        
+        # capture_id -> sheet row for recent captures, least recently used
+        # first. Only a hint: rows move when the sheet is edited by hand.
+        self._row_index: 'OrderedDict[str, int]' = OrderedDict()
+        self._row_index_lock = threading.Lock()
     
     def _get_service(self):
-        """Get or create the Sheets service."""
-        if self._service is None:
-            creds = service_account.Credentials.from_service_account_file(
-                self.credentials_path,
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
-            self._service = build('sheets', 'v4', credentials=creds)
-        return self._service
+        """Get or create the shared Sheets service."""
+        global _service
+        with _service_lock:
+            if _service is None:
+                creds = service_account.Credentials.from_service_account_file(
+                    self.credentials_path,
+                    scopes=['https://www.googleapis.com/auth/spreadsheets']
+                )
+                # Use the discovery document bundled with the client library
+                # rather than fetching it from Google
+                _service = build('sheets', 'v4', http=authorized_http(creds), static_discovery=True)
+            return _service
+    
+    def new_capture_id(self) -> str:
+        """Generate a unique capture ID."""
+        return f"{next(self._capture_ids) & 0xFFFFFFFF:08x}"
     
     def log_capture(
         self,
@@ -43,19 +128,21 @@ class SheetsLogger:
         tuning_session_id: Optional[str] = None,
         iteration: Optional[int] = None,
         notes: Optional[str] = None,
-        metrics: Optional[Dict[str, Any]] = None
+        metrics: Optional[Dict[str, Any]] = None,
+        capture_id: Optional[str] = None
     ) -> Tuple[bool, str]:
         """
-        Log a capture to the Microscope_Captures sheet.
+        Queue a capture for the Microscope_Captures sheet.
+        
+        The row is appended by a background flush together with any other
+        queued rows. A capture_id is generated unless one was already handed out.
         
         Returns:
             Tuple of (success, capture_id)
         """
         try:
-            service = self._get_service()
-            
             # Generate unique capture ID
-            capture_id = str(uuid.uuid4())[:8]
+            capture_id = capture_id or self.new_capture_id()
             timestamp = datetime.now().isoformat()
             
             # Extract parameters
@@ -71,38 +158,138 @@ class SheetsLogger:
                 drive_file_id or '',                 # image_drive_id
                 drive_url or '',                     # image_url
                 local_path,                          # image_local_path
-                params.get('feedRate_mm_min', ''),   # feedRate_mm_min
-                params.get('minPower_pct', ''),      # minPower_pct
-                params.get('maxPower_pct', ''),      # maxPower_pct
-                params.get('quality', ''),           # quality
-                params.get('whiteClip', ''),         # whiteClip
-                params.get('contrast', ''),          # contrast
-                params.get('brightness', ''),        # brightness
-                '',                                  # manual_score (filled by human later)
-                mets.get('metric_contrast', ''),     # metric_contrast (auto-computed)
-                mets.get('metric_sharpness', ''),    # metric_sharpness (auto-computed)
-                mets.get('metric_composite', ''),    # metric_composite (auto-computed)
+            ]
+            row += [params.get(key, '') for key in PARAM_COLUMNS]
+            row += [mets.get(key, '') for key in METRIC_COLUMNS]
+            row += [
                 tuning_session_id or '',             # tuning_session_id
                 iteration if iteration is not None else '',  # iteration
                 notes or ''                          # notes
             ]
             
-            # Append row to sheet
-            service.spreadsheets().values().append(
-                spreadsheetId=self.spreadsheet_id,
-                range=f'{self.sheet_name}!A:U',
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body={'values': [row]}
-            ).execute()
+            # Queue row for the next batched append
+            with self._pending_lock:
+                self._pending.append(row)
+                batch_full = len(self._pending) >= self.batch_size
+                self._ensure_flusher()
+            if batch_full:
+                self._flush_requested.set()
             
-            logger.info(f"Logged capture to sheet: {capture_id}")
+            logger.info(f"Queued capture for sheet: {capture_id}")
             return True, capture_id
             
         except Exception as e:
             logger.error(f"Failed to log capture to sheet: {e}")
             return False, ''
     
+    def _ensure_flusher(self):
+        """Start the flush thread if it isn't running. Pending lock must be held."""
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(
+                target=self._run_flusher,
+                name="sheets-flusher",
+                daemon=True
+            )
+            self._flusher.start()
+    
+    def _run_flusher(self):
+        """Flush thread: append queued rows when a batch fills or the interval passes."""
+        while True:
+            self._flush_requested.wait(timeout=self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+    
+    def flush(self) -> bool:
+        """Append all queued rows to the sheet in a single request."""
+        # Hold the append lock across the swap so batches land in order
+        with self._append_lock:
+            with self._pending_lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return True
+            
+            try:
+                service = self._get_service()
+                result = _execute(service.spreadsheets().values().append(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f'{self.sheet_name}!A:U',
+                    valueInputOption='RAW',
+                    insertDataOption='INSERT_ROWS',
+                    body={'values': rows}
+                ))
+                self._flush_failures = 0
+                
+                # Rows land contiguously, so the first row locates them all
+                first_row = self._first_row(result.get('updates', {}).get('updatedRange', ''))
+                if first_row is not None:
+                    for offset, row in enumerate(rows):
+                        self._remember_row(row[0], first_row + offset)
+                
+                logger.info(f"Logged {len(rows)} capture(s) to sheet")
+                return True
+                
+            except Exception as e:
+                self._flush_failures += 1
+                if self._flush_failures >= MAX_FLUSH_FAILURES:
+                    self._flush_failures = 0
+                    capture_ids = ', '.join(str(row[0]) for row in rows)
+                    logger.error(
+                        f"Dropping {len(rows)} capture(s) after {MAX_FLUSH_FAILURES} "
+                        f"failed flushes ({capture_ids}): {e}"
+                    )
+                    return False
+                
+                # Requeue ahead of rows logged since, so the next flush keeps order
+                with self._pending_lock:
+                    self._pending[:0] = rows
+                logger.error(f"Failed to log {len(rows)} capture(s) to sheet, will retry: {e}")
+                return False
+    
+    @staticmethod
+    def _first_row(updated_range: str) -> Optional[int]:
+        """Parse the first row number from an A1 range like 'Sheet!A57:U60'."""
+        match = re.match(r'[A-Z]+(\d+)', updated_range.rpartition('!')[2])
+        return int(match.group(1)) if match else None
+    
+    def _remember_row(self, capture_id: str, row_index: int):
+        """Cache a capture's row, evicting the least recently used past the limit."""
+        with self._row_index_lock:
+            self._row_index[capture_id] = row_index
+            self._row_index.move_to_end(capture_id)
+            while len(self._row_index) > MAX_CACHED_ROWS:
+                self._row_index.popitem(last=False)
+    
+    def _cached_row(self, capture_id: str) -> Optional[int]:
+        """Get a capture's cached row, if still remembered."""
+        with self._row_index_lock:
+            row_index = self._row_index.get(capture_id)
+            if row_index is not None:
+                self._row_index.move_to_end(capture_id)
+            return row_index
+    
+    def _row_holds(self, row_index: int, capture_id: str) -> bool:
+        """Check that a row still belongs to the capture with a single-cell read."""
+        service = self._get_service()
+        result = service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f'{self.sheet_name}!A{row_index}'
+        ).execute()
+        values = result.get('values', [])
+        return bool(values and values[0] and values[0][0] == capture_id)
+    
+    def _find_row(self, capture_id: str) -> Optional[int]:
+        """Look up a capture's row by scanning column A."""
+        service = self._get_service()
+        result = service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f'{self.sheet_name}!A:A'
+        ).execute()
+        
+        for i, row in enumerate(result.get('values', [])):
+            if row and row[0] == capture_id:
+                return i + 1  # 1-indexed for Sheets
+        return None
+    
     def update_metrics(
         self,
         capture_id: str,
@@ -113,47 +300,41 @@ class SheetsLogger:
     ) -> bool:
         """Update quality metrics for a capture."""
         try:
+            # The capture's row may still be queued
+            self.flush()
             service = self._get_service()
             
-            # Find the row with this capture_id
-            result = service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=f'{self.sheet_name}!A:A'
-            ).execute()
-            
-            values = result.get('values', [])
-            row_index = None
-            for i, row in enumerate(values):
-                if row and row[0] == capture_id:
-                    row_index = i + 1  # 1-indexed for Sheets
-                    break
-            
+            # Find the row with this capture_id. A cached row is checked
+            # first, since rows shift when the sheet is edited by hand; scan
+            # only when it is missing or stale.
+            row_index = self._cached_row(capture_id)
+            if row_index is not None and not self._row_holds(row_index, capture_id):
+                logger.info(f"Cached row {row_index} no longer holds capture {capture_id}")
+                with self._row_index_lock:
+                    self._row_index.pop(capture_id, None)
+                row_index = None
             if row_index is None:
-                logger.warning(f"Capture ID not found: {capture_id}")
-                return False
+                row_index = self._find_row(capture_id)
+                if row_index is None:
+                    logger.warning(f"Capture ID not found: {capture_id}")
+                    return False
+                self._remember_row(capture_id, row_index)
             
-            # Update metrics columns (O, P, Q, R = columns 15-18)
-            updates = []
-            if manual_score is not None:
-                updates.append({
-                    'range': f'{self.sheet_name}!O{row_index}',
-                    'values': [[manual_score]]
-                })
-            if metric_contrast is not None:
-                updates.append({
-                    'range': f'{self.sheet_name}!P{row_index}',
-                    'values': [[metric_contrast]]
-                })
-            if metric_sharpness is not None:
-                updates.append({
-                    'range': f'{self.sheet_name}!Q{row_index}',
-                    'values': [[metric_sharpness]]
-                })
-            if metric_composite is not None:
-                updates.append({
-                    'range': f'{self.sheet_name}!R{row_index}',
-                    'values': [[metric_composite]]
-                })
+            # Update metrics columns
+            values = {
+                'manual_score': manual_score,
+                'metric_contrast': metric_contrast,
+                'metric_sharpness': metric_sharpness,
+                'metric_composite': metric_composite,
+            }
+            updates = [
+                {
+                    'range': f'{self.sheet_name}!{METRIC_COLUMNS[key]}{row_index}',
+                    'values': [[value]]
+                }
+                for key, value in values.items()
+                if value is not None
+            ]
             
             if updates:
                 service.spreadsheets().values().batchUpdate(
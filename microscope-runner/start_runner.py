@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 """Entry point for Microscope Runner service."""
 
+import cv2
 import logging
+import os
 import uvicorn
 from src.config import settings
 
@@ -23,11 +25,24 @@ def main():
     logger.info(f"Local Storage: {settings.local_storage_path}")
     logger.info("=" * 60)
     
+    # OpenCV sizes its pool to the logical CPU count by default
+    cv_threads = settings.cv_threads or max(1, (os.cpu_count() or 2) // 2)
+    cv2.setNumThreads(cv_threads)
+    cv2.setUseOptimized(True)
+    logger.info(f"OpenCV threads: {cv2.getNumThreads()}")
+    
+    # "auto" picks uvloop and httptools when installed (uvloop is not
+    # available on Windows). Keep a single worker: the USB camera can only
+    # be opened by one process.
     uvicorn.run(
         "src.api_server:app",
         host="0.0.0.0",
         port=settings.server_port,
-        reload=False
+        reload=False,
+        workers=1,
+        loop="auto",
+        http="auto",
+        log_level=settings.log_level.lower()
     )
 
 
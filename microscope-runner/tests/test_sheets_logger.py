@@ -0,0 +1,101 @@
+"""Tests for batched Sheets logging, against a stubbed Sheets service."""
+
+import pytest
+
+from src import sheets_logger as sheets_module
+from src.sheets_logger import MAX_FLUSH_FAILURES, SheetsLogger
+
+
+class _Request:
+    def __init__(self, execute):
+        self.execute = execute
+
+
+class StubSheets:
+    """Sheets service that records appended rows and fails while told to."""
+    
+    def __init__(self):
+        self.appended = []
+        self.failing = False
+    
+    def spreadsheets(self):
+        return self
+    
+    def values(self):
+        return self
+    
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        def execute():
+            # Not an HttpError, so _execute doesn't sit through its backoff
+            if self.failing:
+                raise RuntimeError("sheet unavailable")
+            first = len(self.appended) + 2  # row 1 holds the headers
+            self.appended.extend(body['values'])
+            return {'updates': {'updatedRange': f"{range.partition('!')[0]}!A{first}:U{first + len(body['values']) - 1}"}}
+        return _Request(execute)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    stub = StubSheets()
+    monkeypatch.setattr(sheets_module, '_service', stub)
+    return stub
+
+
+@pytest.fixture
+def logger():
+    sheets = SheetsLogger()
+    # Flush only when the test says so
+    sheets.batch_size = 1000
+    sheets.flush_interval = 3600
+    return sheets
+
+
+def _log(sheets, job_number):
+    success, capture_id = sheets.log_capture(job_number=job_number, local_path=f'/captures/{job_number}.jpg')
+    assert success
+    return capture_id
+
+
+def test_failed_flush_requeues_rows_ahead_of_newer_ones(service, logger):
+    first = _log(logger, 'J1')
+    second = _log(logger, 'J2')
+    
+    service.failing = True
+    assert logger.flush() is False
+    assert service.appended == []
+    
+    third = _log(logger, 'J3')
+    service.failing = False
+    assert logger.flush() is True
+    
+    assert [row[0] for row in service.appended] == [first, second, third]
+    assert logger._cached_row(first) == 2
+    assert logger._cached_row(third) == 4
+
+
+def test_rows_dropped_after_max_failed_flushes(service, logger):
+    _log(logger, 'J1')
+    
+    service.failing = True
+    for _ in range(MAX_FLUSH_FAILURES - 1):
+        assert logger.flush() is False
+        assert len(logger._pending) == 1
+    assert logger.flush() is False
+    assert logger._pending == []
+    
+    # The failure count starts over for rows logged afterwards
+    service.failing = False
+    later = _log(logger, 'J2')
+    assert logger.flush() is True
+    assert [row[0] for row in service.appended] == [later]
+
+
+@pytest.mark.parametrize('updated_range, row', [
+    ('Sheet!A57:U60', 57),
+    ("'Microscope Captures'!A57:U60", 57),
+    ("'Runs!2026'!B3:U3", 3),
+    ('', None),
+])
+def test_first_row(updated_range, row):
+    assert SheetsLogger._first_row(updated_range) == row